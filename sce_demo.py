@@ -3,59 +3,109 @@
 * from Dataminr API responses.
 
 Open questions:
-- Should this be a push vs a bulk update (if the latter, how to paginate)?
+- Should this be a push vs a bulk update? (bulk currently, paginating
+  with the from cursor, see iter_alerts)
 - Are alertIds unique? s.t. we can query all alerts and ignore those that exist
 - What's the relationship between lists and alerts?
   - Will there be overlapping alerts between lists?
   - What should list field values be for an alerts feature?
 ********************************************"""
 
+import contextlib
 import datetime
+import functools
 import logging
 import os
 import tempfile
+import threading
 import json
 import shutil
 import requests
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import orjson # https://github.com/ijl/orjson, optional faster json
+except ImportError:
+    orjson = None
+
+try:
+    import numpy as np # optional, bulk timestamp conversion
+except ImportError:
+    np = None
 
 from arcgis.gis import GIS, Item # https://developers.arcgis.com/python/
 
+UTC = datetime.timezone.utc
+AGS_DATE_FORMAT = '%m/%d/%Y %H:%M:%S' # ArcGIS date string format
+
+FETCH_WORKERS = 16 # concurrent Dataminr requests
+FETCH_CHUNK_SIZE = 32 # lists submitted to the fetch pool at a time
+MAX_ALERT_PAGES = 50 # upper bound on pages requested per list
+UPLOAD_TMP_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else None # tmpfs for upload files
+UPLOAD_BATCH_BYTES = 1 << 20 # serialized upload bytes per write
+LAYER_ITEM_ID = 'fcd1dad0687741ae87bac9966fa727e1' # existing layer to update
+STAGING_ITEM_ID = None # optional geojson item reused for appends
+TOKEN_CACHE_DIR = os.environ.get('SCE_DEMO_TOKEN_DIR', os.path.join(os.path.expanduser('~'), '.sce_demo'))
+GIS_TOKEN_MINUTES = 60 # GIS token lifetime requested at sign in
+TOKEN_EXPIRY_MARGIN_MS = 5 * 60 * 1000 # treat tokens as expired this early
+
 """********************************************
 * Utility functions
 ********************************************"""
 
-def extract(obj, keys, **kwargs):
+_MISSING = object() # sentinel for keys that don't exist
+
+def extract(obj, keys, default=None, required=False, warn=False):
     """returns a nested object value for the specified keys"""
-    required = kwargs.pop('required', False)
-    default = kwargs.pop('default', None)
-    warn = kwargs.pop('warn', False)
-    
     o = obj
-    for i in range(0, len(keys)):
-        try:
-            o = o[keys[i]]
-        except (KeyError, IndexError):
+    for k in keys:
+        if isinstance(o, dict):
+            o = o.get(k, _MISSING)
+        elif isinstance(o, (list, tuple)) and isinstance(k, int) and -len(o) <= k < len(o):
+            o = o[k]
+        else:
+            o = _MISSING
+        if o is _MISSING:
             if warn:
-                print('Warning key does not exist. Key: {0} in Keys: {1}'.format(keys[i], keys))
+                print('Warning key does not exist. Key: {0} in Keys: {1}'.format(k, keys))
             if required and default == None:
                 raise KeyError('Required key does not exist in object and no default')
             return default
     return o
 
+@functools.lru_cache(maxsize=256)
+def split_keys(keys_delimited):
+    """returns a tuple of keys for a delimited string, cached since the
+    same literal keys are split for every object"""
+    return tuple(keys_delimited.split('.'))
+
 def d_extract(obj, keys_delimited, **kwargs):
     """returns a nested object value for delimited keys"""
-    keys = keys_delimited.split('.')
-    return extract(obj, keys, **kwargs)
+    return extract(obj, split_keys(keys_delimited), **kwargs)
+
+def json_dumps(obj):
+    """returns utf-8 encoded json bytes for an object"""
+    if orjson:
+        return orjson.dumps(obj)
+    return json.dumps(obj).encode('utf-8')
+
+def json_loads(data):
+    """returns the object parsed from json bytes or str"""
+    if orjson:
+        return orjson.loads(data)
+    return json.loads(data)
 
 def row_to_geojson(row, lon_field, lat_field):
-    """returns a geojson feature for a flat dictionary row"""
+    """returns a geojson feature for a flat dictionary row, note the row
+    is used as the feature properties without copying"""
     return {
         'type': 'Feature',
         'geometry': {
             'type': 'Point',
-            'coordinates': [row[lat_field], row[lon_field]]
+            'coordinates': [row[lon_field], row[lat_field]]
         },
-        'properties': {**row}
+        'properties': row
     }
 
 def rows_to_geojson(rows, lon_field, lat_field):
@@ -66,66 +116,172 @@ def rows_to_geojson(rows, lon_field, lat_field):
         'features': features
     }
 
+def iter_geojson_features(rows, lon_field, lat_field):
+    """yields geojson features for flat dictionary rows"""
+    for r in rows:
+        yield row_to_geojson(r, lon_field, lat_field)
+
+def iter_geojson_bytes(geojson, batch_size=UPLOAD_BATCH_BYTES):
+    """yields json byte batches of about batch_size for geojson, where geojson
+    is either a dict or an iterable of features streamed one at a time as a
+    feature collection"""
+    if isinstance(geojson, dict):
+        yield json_dumps(geojson)
+        return
+    buf = bytearray(b'{"type":"FeatureCollection","features":[')
+    for i, feature in enumerate(geojson):
+        if i:
+            buf += b','
+        buf += json_dumps(feature)
+        if len(buf) >= batch_size:
+            yield buf
+            buf = bytearray() # new buffer, the yielded one may still be in use
+    buf += b']}'
+    yield buf
+
+def write_geojson(fp, geojson):
+    """writes geojson to a binary file (see iter_geojson_bytes)"""
+    for chunk in iter_geojson_bytes(geojson):
+        fp.write(chunk)
+
 def date_to_ags(date):
     """Returns an ArcGIS-formatted date from a Python date object"""
-    tz = datetime.timezone.utc
-    return date.astimezone(tz).strftime('%m/%d/%Y %H:%M:%S')
+    return date.astimezone(UTC).strftime(AGS_DATE_FORMAT)
+
+def date_to_timestamp(date):
+    """Returns a ms timestamp from a Python date object"""
+    return int(date.timestamp() * 1000)
 
 def timestamp_to_ags(timestamp):
     """Returns an ArcGIS-formatted date from a ms timestamp"""
     seconds = timestamp / 1000
-    date = datetime.datetime.fromtimestamp(seconds)
-    return date_to_ags(date)
+    return datetime.datetime.fromtimestamp(seconds, UTC).strftime(AGS_DATE_FORMAT)
+
+def timestamps_to_ags(timestamps):
+    """Returns ArcGIS-formatted dates for a list of ms timestamps"""
+    if np is None:
+        return [timestamp_to_ags(t) for t in timestamps]
+    dates = np.array(timestamps, dtype='int64').astype('datetime64[ms]')
+    # reorder numpy's 'YYYY-MM-DDTHH:MM:SS' utc strings as AGS_DATE_FORMAT
+    return [d[5:7] + '/' + d[8:10] + '/' + d[:4] + ' ' + d[11:]
+        for d in np.datetime_as_string(dates, unit='s').tolist()]
+
+def token_cache_path(name):
+    """returns the token cache file path for a service account name"""
+    return os.path.join(TOKEN_CACHE_DIR, '{0}.json'.format(name))
+
+def load_token(path):
+    """returns a cached token if one exists and hasn't expired, else None"""
+    try:
+        with open(path, 'rb') as fp:
+            cached = json_loads(fp.read())
+        now = date_to_timestamp(datetime.datetime.now(UTC))
+        if cached['expires_at'] - TOKEN_EXPIRY_MARGIN_MS > now:
+            return cached['token']
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+    return None
+
+def save_token(path, token, expires_at):
+    """caches a token with its ms expiry timestamp, readable only by the user"""
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'wb') as fp:
+            fp.write(json_dumps({'token': token, 'expires_at': expires_at}))
+    except OSError as e:
+        logging.warning('Could not cache token: {0}'.format(str(e)))
+
+def delete_token(path):
+    """removes a cached token, e.g. after it was rejected"""
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+def chunks(items, size):
+    """yields successive lists of at most size items"""
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
 
 """********************************************
 * Dataminr API response parsing functions
 ********************************************"""
 
-def alert_to_row(obj):
+# simple JSON parsed values as (field, keys, required), keys are
+# split here once instead of for every alert
+ALERT_SCHEMA = [
+    ('alert_id', ('alertId',), True), #hardcoded later to identify alerts
+    ('place', ('eventLocation', 'name'), False),
+    ('alert_type', ('alertType', 'name'), False),
+    ('alert_type_color', ('alertType', 'color'), False),
+    ('caption', ('caption',), False),
+    ('publisher_category', ('publisherCategory', 'name'), False),
+    ('publisher_category_color', ('publisherCategory', 'color'), False),
+    ('related_terms_query_url', ('relatedTermsQueryURL',), False),
+    ('expand_alert_url', ('expandAlertURL',), False),
+    ('post_text', ('post', 'text'), False),
+    ('post_text_transl', ('post', 'translatedText'), False),
+    # dataminr coordinates are [lat, lon], unlike geojson
+    ('lat', ('eventLocation', 'coordinates', 0), False),
+    ('lon', ('eventLocation', 'coordinates', 1), False)
+]
+
+def alert_to_row(obj, _schema=ALERT_SCHEMA):
     """returns a flat dictionary row parsed from a dataminr alert object"""
-    f_e = lambda keys, **kwargs: extract(obj, keys, warn=False, **kwargs)
-    f_de = lambda keys, **kwargs: d_extract(obj, keys, warn=False, **kwargs)
     
     # simple JSON parsed values
-    props = {
-        'alert_id': f_de('alertId', required=True), #hardcoded later to identify alerts
-        'place': f_de('eventLocation.name'),
-        'alert_type': f_de('alertType.name'),
-        'alert_type_color': f_de('alertType.color'),
-        'caption': f_de('caption'),
-        'publisher_category': f_de('publisherCategory.name'),
-        'publisher_category_color': f_de('publisherCategory.color'),
-        'related_terms_query_url': f_de('relatedTermsQueryURL'),
-        'expand_alert_url': f_de('expandAlertURL'),
-        'post_text': f_de('post.text'),
-        'post_text_transl': f_de('post.translatedText'),
-        'lon': f_e(['eventLocation','coordinates',0]),
-        'lat': f_e(['eventLocation','coordinates',1])
-    }
+    props = {}
+    for field, keys, required in _schema:
+        o = obj
+        try:
+            for k in keys:
+                o = o[k]
+        except (KeyError, IndexError, TypeError):
+            if required:
+                raise KeyError('Required key does not exist in object and no default')
+            o = None
+        props[field] = o
     
-    # JSON parsed values with manipulations
-    event_time = f_de('eventTime') # hardcoded later to delete old events
+    # JSON parsed values with manipulations, looked up directly since
+    # this runs for every alert
+    # ms timestamps are converted per batch in alerts_to_rows
+    event_time = obj.get('eventTime') # hardcoded later to delete old events
     if event_time and event_time > 0:
-        props['event_time'] = timestamp_to_ags(event_time)
+        props['event_time'] = event_time
+        props['event_time_ms'] = event_time # numeric copy, see EVENT_TIME_MS_FIELD
         
-    post_time = f_de('post.timestamp')
+    post_time = (obj.get('post') or {}).get('timestamp')
     if post_time and post_time > 0:
-        props['post_time'] = timestamp_to_ags(post_time)
+        props['post_time'] = post_time
         
-    channels = f_de('source.channels')
+    channels = (obj.get('source') or {}).get('channels')
     if channels:
         props['source'] = ','.join(channels)
         
-    terms = f_de('relatedTerms')
+    # str.join builds a list from generators anyway, so list comprehensions
+    # are faster here for the short lists alerts carry
+    terms = obj.get('relatedTerms')
     if terms:
         props['related_terms'] = ','.join([t['text'] for t in terms])
         
-    categories = f_de('categories')
+    categories = obj.get('categories')
     if categories:
         props['categories'] = ','.join([c['name'] for c in categories])
         
     return props
 
+def alerts_to_rows(objs, time_fields=('event_time', 'post_time')):
+    """returns flat dictionary rows parsed from a list of dataminr alert objects,
+    converting each timestamp column to ArcGIS dates in one batch"""
+    rows = [alert_to_row(o) for o in objs]
+    for field in time_fields:
+        col = [r for r in rows if field in r]
+        dates = timestamps_to_ags([r[field] for r in col])
+        for r, date in zip(col, dates):
+            r[field] = date
+    return rows
+
 def list_to_row(obj):
     """returns a flat dictionary parsed from a dataminr list object"""
     f_de = lambda keys, **kwargs: d_extract(obj, keys, warn=True, **kwargs)
@@ -139,32 +295,133 @@ def list_to_row(obj):
 * Dataminr API wrappers
 ********************************************"""
 
-def get_auth_header(client_id, client_secret):
-    params = {'grant_type': 'api_key', 'client_id': client_id, 'client_secret': client_secret}
-    r = requests.post('https://gateway.dataminr.com/auth/2/token', params)
-    j = r.json()
-    return {'Authorization': 'dmauth {0}'.format(j['dmaToken'])}
-
-def get_lists(headers):
-    r = requests.get('https://gateway.dataminr.com/account/2/get_lists', headers=headers)
-    j = r.json()
+def get_session():
+    """returns a requests session that pools connections across API calls"""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=32, pool_maxsize=64)
+    session.mount('https://', adapter)
+    return session
+
+def get_auth_header(session, client_id, client_secret, refresh=False):
+    # reuse the cached token across runs until it expires, refresh discards
+    # the cached token and requests a new one
+    cache_path = token_cache_path('dataminr_{0}'.format(client_id))
+    if refresh:
+        delete_token(cache_path)
+    token = load_token(cache_path)
+    if not token:
+        params = {'grant_type': 'api_key', 'client_id': client_id, 'client_secret': client_secret}
+        r = session.post('https://gateway.dataminr.com/auth/2/token', params)
+        r.raise_for_status()
+        j = json_loads(r.content)
+        token = j['dmaToken']
+        if j.get('expire'):
+            save_token(cache_path, token, j['expire'])
+    return {'Authorization': 'dmauth {0}'.format(token)}
+
+def call_with_auth(session, client, client_headers, client_locks, fn):
+    """returns fn called with the (client id, secret) client's auth header from
+    client_headers, re-authenticating once if Dataminr rejects the token"""
+    headers = client_headers[client]
+    try:
+        return fn(headers)
+    except requests.HTTPError as e:
+        if e.response is None or e.response.status_code != 401:
+            raise
+
+    # fetch threads share tokens, so only the first thread to see the rejected
+    # header refreshes it and the others retry with the refreshed header
+    with client_locks[client]:
+        if client_headers[client] is headers:
+            logging.warning('Dataminr token rejected for client {0}, re-authenticating'.format(client[0]))
+            client_headers[client] = get_auth_header(session, *client, refresh=True)
+        headers = client_headers[client]
+    return fn(headers)
+
+def get_lists(session, headers):
+    r = session.get('https://gateway.dataminr.com/account/2/get_lists', headers=headers)
+    r.raise_for_status()
+    j = json_loads(r.content)
     topics = d_extract(j, 'watchlists.TOPIC', default=[])
     companies = d_extract(j, 'watchlists.COMPANY', default=[])
     custom = d_extract(j, 'watchlists.CUSTOM', default=[])
     lists = topics + companies + custom
     return [list_to_row(l) for l in lists]
 
-def get_alerts(headers, list_ids, **kwargs):
+def get_alerts(session, headers, list_ids, **kwargs):
     pagesize = kwargs.pop('pagesize', 100)
     params = {'alertversion': 14, 'lists': list_ids, 'pagesize': pagesize, **kwargs}
-    r = requests.get('https://gateway.dataminr.com/alerts/2/get_alert', params=params, headers=headers)
-    alerts = r.json()
-    return [alert_to_row(a) for a in alerts]
+    r = session.get('https://gateway.dataminr.com/alerts/2/get_alert', params=params, headers=headers)
+    r.raise_for_status()
+    alerts = json_loads(r.content)
+    return alerts_to_rows(alerts)
+
+def iter_alerts(session, headers, list_ids, pagesize=100, max_pages=MAX_ALERT_PAGES):
+    """yields pages of alert rows, passing the last alert id of each page as the
+    from cursor until a short page is returned or max_pages is reached"""
+    cursor = None
+    for _ in range(max_pages):
+        params = {'from': cursor} if cursor else {}
+        try:
+            alerts = get_alerts(session, headers, list_ids, pagesize=pagesize, **params)
+        except requests.HTTPError as e:
+            # only the first page is required, keep the pages already fetched
+            # if a follow up page fails. Rejected tokens still propagate so
+            # the caller can re-authenticate
+            unauthorized = e.response is not None and e.response.status_code == 401
+            if not cursor or unauthorized:
+                raise
+            logging.warning('Error paginating alerts for lists {0}, keeping pages fetched so far: {1}'.format(list_ids, str(e)))
+            return
+        if alerts:
+            yield alerts
+        if len(alerts) < pagesize or alerts[-1]['alert_id'] == cursor:
+            return
+        cursor = alerts[-1]['alert_id']
+    logging.warning('Stopped after {0} pages of alerts for lists {1}, remaining alerts were not fetched'.format(max_pages, list_ids))
 
 """********************************************
 * ArcGIS functions
 ********************************************"""
 
+@contextlib.contextmanager
+def geojson_tempfile(geojson):
+    """Writes geojson to a tempfile and yields its path, geojson can be a
+    dict or an iterable of features (see iter_geojson_bytes)"""
+    # the api needs a file path so use an in-memory tmpfs where available
+    # to skip the disk write. tmpfs can be small (64MB in containers by
+    # default) or not writable, so on failure spill what was written plus
+    # the rest to the default temp dir, streamed features can't be
+    # serialized again. Batches are written unbuffered so the unwritten
+    # remainder is known on failure
+    batches = iter_geojson_bytes(geojson)
+    with contextlib.ExitStack() as stack:
+        fp = spilled = None
+        rest = b''
+        if UPLOAD_TMP_DIR:
+            try:
+                fp = stack.enter_context(tempfile.NamedTemporaryFile(
+                    suffix='.geojson', dir=UPLOAD_TMP_DIR, buffering=0))
+                for batch in batches:
+                    rest = memoryview(batch)
+                    while rest:
+                        rest = rest[fp.write(rest):]
+            except OSError as e:
+                logging.warning('Could not write upload to {0}, using the default temp dir: {1}'.format(UPLOAD_TMP_DIR, str(e)))
+                spilled, fp = fp, None
+
+        if fp is None:
+            fp = stack.enter_context(tempfile.NamedTemporaryFile(suffix='.geojson'))
+            if spilled:
+                spilled.seek(0)
+                shutil.copyfileobj(spilled, fp)
+                spilled.close() # frees the tmpfs space
+            fp.write(rest)
+            for batch in batches:
+                fp.write(batch)
+            fp.flush()
+        yield fp.name
+
 def add_geojson(gis, geojson, **item_options):
     """Uploads geojson and returns the file item"""
     # get default args
@@ -172,17 +429,22 @@ def add_geojson(gis, geojson, **item_options):
     tags = item_options.pop('tags', 'dataminr-poc')
         
     # save geojson to tempfile and add as item
-    with tempfile.NamedTemporaryFile(mode="w", suffix='.geojson') as fp:
-        fp.write(json.dumps(geojson))
+    with geojson_tempfile(geojson) as path:
         item = gis.content.add({
             **item_options,
             'type': 'GeoJson',
             'title': title,
             'tags': tags,
-        }, data=fp.name)
+        }, data=path)
     
     return item
 
+def update_geojson(item, geojson):
+    """Replaces the data of an existing geojson file item and returns the item"""
+    with geojson_tempfile(geojson) as path:
+        item.update(data=path)
+    return item
+
 def create_scratch_layer(gis, geojson, **item_options):
     """Publishes parsed dataminr geojson as a service and returns the resulting layer item
     
@@ -224,15 +486,21 @@ def create_layer(gis, geojson, template_item):
 
     return append_to_layer(gis, lyr, geojson)
 
-def append_to_layer(gis, layer, geojson):
+def append_to_layer(gis, layer, geojson, staging_item=None):
     """Appends parsed dataminr geojson to an existing service
     
     Note, this is the best approach for bulk updates in ArcGIS Online.
     There are other options here, such as transactional edits
     > https://github.com/mpayson/esri-partner-tools/blob/master/feature_layers/update_data.ipynb
+
+    If a staging geojson item is given its data is replaced and the item is
+    kept for the next append, otherwise a temporary item is added and deleted.
     """
 
-    item = add_geojson(gis, geojson, title="Dataminr update")
+    if staging_item:
+        item = update_geojson(staging_item, geojson)
+    else:
+        item = add_geojson(gis, geojson, title="Dataminr update")
     result = layer
     test = item.id
     try:
@@ -246,57 +514,192 @@ def append_to_layer(gis, layer, geojson):
     except Exception as e:
         logging.error('Error appending data to existing layer: {0}'.format(str(e)))
     finally:
-      item.delete() # if not deleted next run will eror
+      if not staging_item:
+        item.delete() # if not deleted next run will eror
     
     return result
 
-def delete_before(lyr, date, field):
-    """Deletes all features in a layer before a given date"""
-    where = "{0} < '{1}'".format(field, date_to_ags(date))
+def get_gis(gis_un, gis_pw):
+    """Signs in to GIS and returns it, reusing a cached token from a
+    previous run when one hasn't expired"""
+    cache_path = token_cache_path('gis_{0}'.format(gis_un))
+    token = load_token(cache_path)
+    if token:
+        try:
+            return GIS(token=token)
+        except Exception as e:
+            logging.warning('Cached GIS token rejected, signing in: {0}'.format(str(e)))
+
+    # the token lifetime is requested explicitly rather than assumed, portals
+    # honour it up to their maxTokenExpirationMinutes (two weeks on ArcGIS
+    # Online). Expiry is counted from before sign in so it errs early, and a
+    # portal capping tokens shorter is still covered by the fallback above.
+    # the api has no public token accessor, hence _con
+    signed_in_at = date_to_timestamp(datetime.datetime.now(UTC))
+    gis = GIS(username=gis_un, password=gis_pw, expiration=GIS_TOKEN_MINUTES)
+    expires_at = signed_in_at + GIS_TOKEN_MINUTES * 60 * 1000
+    save_token(cache_path, gis._con.token, expires_at)
+    return gis
+
+# numeric copy of event_time for integer comparisons, epoch ms values
+# (~1.7e12) overflow a 32 bit esriFieldTypeInteger so store as a Double
+EVENT_TIME_MS_FIELD = {
+    'name': 'event_time_ms',
+    'type': 'esriFieldTypeDouble',
+    'alias': 'event_time_ms',
+    'nullable': True,
+    'editable': True
+}
+
+def add_missing_field(lyr, field_def):
+    """Adds a field to a layer's definition if a field with that name
+    doesn't already exist"""
+    names = [f['name'].lower() for f in lyr.properties.fields]
+    if field_def['name'].lower() in names:
+        return
+    logging.info('Adding field {0} to layer'.format(field_def['name']))
+    lyr.manager.add_to_definition({'fields': [field_def]})
+
+def prepare_layer(gis_un, gis_pw, item_id, number_days, field, ms_field=None):
+    """Signs in to GIS, deletes features older than number_days from the
+    item's first layer and returns the gis, item and layer
+
+    If a numeric ms_field definition is given it's added to the layer when
+    missing and used for the delete, falling back to the string field for
+    features appended before the ms field existed"""
+
+    gis = get_gis(gis_un, gis_pw)
+
+    # check to see if a layer already exists, if so update, else create
+    # can alternatively save layer item ids to a store then reference
+    item = Item(gis, item_id)
+    lyr = item.layers[0]
+    if ms_field:
+        add_missing_field(lyr, ms_field)
+        delete_before_days(lyr, number_days, ms_field['name'], numeric=True, fallback_field=field)
+    else:
+        delete_before_days(lyr, number_days, field) #delete old features
+    return gis, item, lyr
+
+def delete_before(lyr, date, field, numeric=False, fallback_field=None):
+    """Deletes all features in a layer before a given date, numeric fields
+    hold ms timestamps and are compared as integers instead of date strings.
+    Features with a null numeric field are compared on the fallback date
+    string field instead, in the same request"""
+    if numeric:
+        where = "{0} < {1}".format(field, date_to_timestamp(date))
+        if fallback_field:
+            where = "{0} OR ({1} IS NULL AND {2} < '{3}')".format(
+                where, field, fallback_field, date_to_ags(date))
+    else:
+        where = "{0} < '{1}'".format(field, date_to_ags(date))
     return lyr.delete_features(where=where)
 
-def delete_before_days(lyr, number_days, field):
+def delete_before_days(lyr, number_days, field, numeric=False, fallback_field=None):
     """Deletes all features with dates before the specified
     number of days back from today"""
     dt = datetime.datetime.today() - datetime.timedelta(number_days)
-    return delete_before(lyr, dt, field)
+    return delete_before(lyr, dt, field, numeric, fallback_field)
 
 
 """********************************************
 * The main show
 ********************************************"""
 
-def run(gis_un, gis_pw, client_id, client_secret):
-
-    # if user has previously signed in to system, can also construct with token
-    # > gis = GIS(token="<access token>")
-    logging.info('Authenticating to GIS and Dataminr')
-    gis = GIS(username=gis_un, password=gis_pw)
-    headers = get_auth_header(client_id, client_secret)
+def get_env(name):
+    """returns a required environment variable"""
+    value = os.environ.get(name)
+    if not value:
+        raise KeyError('Required environment variable {0} is not set'.format(name))
+    return value
+
+def get_env_list(name):
+    """returns the non-empty entries of a comma separated environment variable"""
+    values = [v.strip() for v in get_env(name).split(',') if v.strip()]
+    if not values:
+        raise KeyError('Required environment variable {0} has no values'.format(name))
+    return values
+
+def get_env_credentials():
+    """Returns GIS credentials and a list of (client id, secret) Dataminr
+    clients read from the environment. Multiple Dataminr clients of the same
+    account can be set as comma separated DATAMINR_CLIENT_IDS and
+    DATAMINR_CLIENT_SECRETS, a single client's DATAMINR_CLIENT_ID and
+    DATAMINR_CLIENT_SECRET are used as is"""
+    gis_un = get_env('ARCGIS_USERNAME')
+    gis_pw = get_env('ARCGIS_PASSWORD')
+    if 'DATAMINR_CLIENT_IDS' in os.environ:
+        client_ids = get_env_list('DATAMINR_CLIENT_IDS')
+        client_secrets = get_env_list('DATAMINR_CLIENT_SECRETS')
+    else:
+        client_ids = [get_env('DATAMINR_CLIENT_ID').strip()]
+        client_secrets = [get_env('DATAMINR_CLIENT_SECRET')]
+    if len(client_ids) != len(client_secrets):
+        raise ValueError('Number of Dataminr client ids and secrets do not match')
+    return gis_un, gis_pw, list(zip(client_ids, client_secrets))
+
+def fetch_alerts(dm_clients):
+    """Returns deduplicated alert rows, merged with their list fields, for
+    every list of the (client id, secret) Dataminr clients
+
+    Note, lists are read with the first client only then spread across all
+    clients, so every client must belong to the same Dataminr account."""
+    session = get_session()
+    client_headers = {c: get_auth_header(session, *c) for c in dm_clients}
+    client_locks = {c: threading.Lock() for c in dm_clients}
 
     # get alerts for each list, note alert ids need to be unique so only 
     # use the alert the first time it is returned from a list request
     # TODO is this the best approach?
+    # requests are latency bound so fetch lists concurrently, submitting
+    # in chunks to bound the number of in-flight requests. Lists are spread
+    # round robin across clients so each draws on its own rate limit
+    lists = call_with_auth(session, dm_clients[0], client_headers, client_locks,
+        lambda h: get_lists(session, h))
+    list_clients = [dm_clients[i % len(dm_clients)] for i in range(len(lists))]
+    fetch = lambda l, c: (l, call_with_auth(session, c, client_headers, client_locks,
+        lambda h: list(iter_alerts(session, h, str(l['list_id']), pagesize=100))))
+    results = []
+    with ThreadPoolExecutor(max_workers=FETCH_WORKERS) as ex:
+        for chunk, chunk_clients in zip(chunks(lists, FETCH_CHUNK_SIZE), chunks(list_clients, FETCH_CHUNK_SIZE)):
+            results.extend(ex.map(fetch, chunk, chunk_clients))
+
+    alerts_by_id = {}
+    for l, pages in results:
+        for new_alerts in pages:
+            for a in new_alerts:
+                if a['alert_id'] not in alerts_by_id:
+                    a.update(l) # rows are fresh per request, safe to mutate
+                    alerts_by_id[a['alert_id']] = a
+    return list(alerts_by_id.values())
+
+def run(gis_un, gis_pw, dm_clients):
+
+    # the GIS sign in and old feature cleanup don't depend on Dataminr
+    # so run them in the background while alerts are fetched
+    logging.info('Authenticating to GIS and Dataminr')
+    gis_ex = ThreadPoolExecutor(max_workers=1)
+    gis_future = gis_ex.submit(prepare_layer, gis_un, gis_pw, LAYER_ITEM_ID, 30, 'event_time', EVENT_TIME_MS_FIELD)
+    gis_ex.shutdown(wait=False)
+
     logging.info('Getting Dataminr data')
-    lists = get_lists(headers)
-    alerts = []
-    alert_ids = set()
-    for l in lists:
-        new_alerts = get_alerts(headers, str(l['list_id']), pagesize=100)
-        for a in new_alerts:
-            if a['alert_id'] in alert_ids:
-                continue
-            alerts.append({**a, **l})
-            alert_ids.add(a['alert_id'])
-    geojson = rows_to_geojson(alerts, 'lon', 'lat')
+    try:
+        alerts = fetch_alerts(dm_clients)
+    except Exception:
+        # wait on the GIS work so its errors aren't lost. The delete may have
+        # run without an append, that's acceptable since it only removes
+        # features past the 30 day window which the next run would drop anyway
+        try:
+            gis_future.result()
+        except Exception as e:
+            logging.error('Error preparing layer: {0}'.format(str(e)))
+        raise
 
-    # check to see if a layer already exists, if so update, else create
-    # can alternatively save layer item ids to a store then reference
-    item = Item(gis, 'fcd1dad0687741ae87bac9966fa727e1')
-    lyr = item.layers[0]
-    delete_before_days(lyr,30,'event_time') #delete old features
+    gis, item, lyr = gis_future.result()
+    staging_item = Item(gis, STAGING_ITEM_ID) if STAGING_ITEM_ID else None
     logging.info('Updating existing layer {0} with {1} alerts'.format(item.id, len(alerts)))
-    append_to_layer(gis, lyr, geojson)
+    # features are streamed to the upload rather than built up front
+    append_to_layer(gis, lyr, iter_geojson_features(alerts, 'lon', 'lat'), staging_item)
     
     #search_items = gis.content.search('title:"test" AND type:"Feature Service"')
     #if len(search_items) > 0:
@@ -324,9 +727,4 @@ if __name__ == "__main__":
     
     logging.getLogger().setLevel(logging.INFO)
 
-    ags_un = 'mliss_dataminr1'
-    ags_pw = '9IIwSp1!f1Hf'
-    dm_id = 'f2c34fe6e15f4537ab3312af9ce9f11f'
-    dm_se = 'eb106dfd83df4fb09331d08496c1b174'
-
-    run(ags_un, ags_pw, dm_id, dm_se)
+    run(*get_env_credentials())